@@ -3,62 +3,113 @@
 # See LICENSE file for licensing details.
 """A Juju charm for k6 on Kubernetes."""
 
+import hashlib
 import logging
+from functools import cached_property, wraps
 from pathlib import Path
 import re
-from typing import Dict, List, Optional, cast
+from typing import TYPE_CHECKING, Callable, Optional, cast
 
 import ops_tracing
-from charms.k6_k8s.v0.k6_test import K6TestRequirer
 from charms.istio_beacon_k8s.v0.service_mesh import ServiceMeshConsumer, UnitPolicy
-from charms.loki_k8s.v1.loki_push_api import LokiPushApiConsumer
-from charms.prometheus_k8s.v1.prometheus_remote_write import PrometheusRemoteWriteConsumer
+from charms.k6_k8s.v0.k6_test import K6TestRequirer
 from ops import ActionEvent, CharmBase, main
+from ops.framework import StoredState
 from ops.model import ActiveStatus
+from ops.pebble import ChangeError, ExecError
 
-from k6 import K6, PORTS
+from k6 import K6, PORTS, STATUS_PORT
+
+if TYPE_CHECKING:
+    from charms.loki_k8s.v1.loki_push_api import LokiPushApiConsumer
+    from charms.prometheus_k8s.v1.prometheus_remote_write import PrometheusRemoteWriteConsumer
 
 logger = logging.getLogger(__name__)
 
+# k6 v0.57.0 (go1.22.12, linux/amd64) ...
+_K6_VERSION_RE = re.compile(r"k6 v(\d+\.\d+\.\d+)")
+
+ActionHandler = Callable[["K6K8sCharm", ActionEvent], None]
+
+
+def _digest(content: str) -> str:
+    """Return the digest used to tell whether a script changed since it was pushed."""
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def leader_action(handler: ActionHandler) -> ActionHandler:
+    """Fail the decorated action if it's not run on the leader unit."""
+
+    @wraps(handler)
+    def wrapper(charm: "K6K8sCharm", event: ActionEvent) -> None:
+        if not charm.unit.is_leader():
+            event.fail("You can only run this action on the leader unit.")
+            return
+        handler(charm, event)
+
+    return wrapper
+
 
 class K6K8sCharm(CharmBase):
     """Charm to run k6 on Kubernetes."""
 
+    _container_name = "k6"
     _scripts_folder = Path("/etc/k6/scripts")
     _default_script_path = "/etc/k6/scripts/juju-config-script.js"
-    _ports = list(PORTS.__dict__.values())
+    _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        # Digests of the scripts pushed to the container, keyed by path
+        self._stored.set_default(script_hashes={})
+        # Only wired when the observability relations exist
+        self.prometheus: Optional["PrometheusRemoteWriteConsumer"] = None
+        self.loki: Optional["LokiPushApiConsumer"] = None
         self.tracing = ops_tracing.Tracing(
             self,
             tracing_relation_name="charm-tracing",
             ca_relation_name="receive-ca-cert",
         )
-        self.container = self.unit.get_container("k6")
+        self.container = self.unit.get_container(self._container_name)
         if not self.container.can_connect():
             return
 
-        self.prometheus = PrometheusRemoteWriteConsumer(self, peer_relation_name="k6")
-        self.loki = LokiPushApiConsumer(self)
         self.k6_tests = K6TestRequirer(self)
-        prometheus_endpoints = self.prometheus.endpoints
-        loki_endpoints = self.loki.loki_endpoints
+        # Parse the relation-provided tests once per hook
+        self._tests = self.k6_tests.tests or {}
+        # Only import and wire the observability libraries when they are related
+        prometheus_endpoint: Optional[str] = None
+        if self.model.relations["send-remote-write"]:
+            from charms.prometheus_k8s.v1.prometheus_remote_write import (
+                PrometheusRemoteWriteConsumer,
+            )
+
+            self.prometheus = PrometheusRemoteWriteConsumer(self, peer_relation_name="k6")
+            if endpoints := self.prometheus.endpoints:
+                prometheus_endpoint = endpoints[0]["url"]
+        loki_endpoint: Optional[str] = None
+        if self.model.relations["logging"]:
+            from charms.loki_k8s.v1.loki_push_api import LokiPushApiConsumer
+
+            self.loki = LokiPushApiConsumer(self)
+            if endpoints := self.loki.loki_endpoints:
+                loki_endpoint = endpoints[0]["url"]
         self.k6 = K6(
             charm=self,
-            prometheus_endpoint=prometheus_endpoints[0]["url"] if prometheus_endpoints else None,
-            loki_endpoint=loki_endpoints[0]["url"] if loki_endpoints else None,
+            prometheus_endpoint=prometheus_endpoint,
+            loki_endpoint=loki_endpoint,
         )
         self._mesh = ServiceMeshConsumer(
             self,
             policies=[
                 UnitPolicy(
                     relation="k6",  # when related over k6 (peers) relation
-                    ports=[PORTS.status],  # allow the source (other peer workloads) to acces the status port of the target workload
+                    ports=[STATUS_PORT],  # allow the source (other peer workloads) to acces the status port of the target workload
                 ),
             ]
         )
         self._reconcile()
+        self.framework.observe(self.on.k6_pebble_ready, self._on_pebble_ready)
         # Juju actions
         self.framework.observe(self.on.start_action, self._on_start_action)
         self.framework.observe(self.on.stop_action, self._on_stop_action)
@@ -66,17 +117,21 @@ class K6K8sCharm(CharmBase):
 
     def _reconcile(self):
         """Recreate the world state for the charm."""
-        self.unit.set_ports(*self._ports)
+        self.unit.set_ports(*PORTS)
         self.unit.set_workload_version(self._k6_version or "")
         self.push_script_from_config()
         self.push_tests_from_relations()
         self.unit.status = ActiveStatus()
 
+    def _on_pebble_ready(self, _) -> None:
+        """Push all the scripts again, as the container filesystem might be new."""
+        self._stored.script_hashes = {}
+        self.push_script_from_config()
+        self.push_tests_from_relations()
+
+    @leader_action
     def _on_start_action(self, event: ActionEvent) -> None:
         """Run a load test script with `k6 run`."""
-        if not self.unit.is_leader():
-            event.fail("You can only run the action on the leader unit.")
-            return
         if self.k6.is_running():
             event.fail("A load test is already running; please wait for it to finish.")
             return
@@ -90,69 +145,69 @@ class K6K8sCharm(CharmBase):
             else self._default_script_path
         )
 
-        if not self.container.exists(script_path):
-            if target_test:
-                event.fail("No script found; make sure you're specifying the correct name.")
-            else:
+        if not target_test:
+            # The config script was just pushed by _reconcile: check it in memory
+            if not self.config.get("load-test"):
                 event.fail("No script found; set a script via `juju config load-test=@file.js`")
+                return
+        elif not self.container.exists(script_path):
+            event.fail("No script found; make sure you're specifying the correct name.")
             return
 
         # Run the k6 script
         self.k6.run(script_path=script_path)
         event.log(f"Load test {script_path} started on all units")
 
+    @leader_action
     def _on_stop_action(self, event: ActionEvent) -> None:
-        if not self.unit.is_leader():
-            event.fail("You can only run this action on the leader unit.")
-            return
         self.k6.stop()
 
+    @leader_action
     def _on_list_action(self, event: ActionEvent) -> None:
         """Print all the available tests, by the 'app' and 'test' args for the 'start' action."""
-        if not self.unit.is_leader():
-            event.fail("You can only run this action on the leader unit.")
-            return
-        # Gather all the available tests
-        available_tests: List[Dict[str, str]] = []
-        # Add the side-loaded test from Juju config
-        available_tests.append({"app": "", "test": ""})
-        # Add the tests from relation data
-        tests = self.k6_tests.tests
-        if not tests:
-            return
-        for app, tests in tests.items():
-            for test_name in tests.keys():
-                available_tests.append({"app": app, "test": test_name})
-        # Print the available tests
-        event.log(f"Available tests (pass the args to the 'start' action):\n{available_tests}")
+        # The side-loaded test from Juju config, then the tests from relation data
+        lines = ["(no app) -> (default config script)"]
+        lines.extend(
+            f"{app} -> {test_name}"
+            for app, tests in self._tests.items()
+            for test_name in tests
+        )
+        event.log("Available tests (pass the args to the 'start' action):\n" + "\n".join(lines))
 
     def push_script_from_config(self):
         """Push the k6 script in Juju config to the container."""
         script = cast(str, self.config.get("load-test", None))
         if script:
-            self.container.push(self._default_script_path, script, make_dirs=True)
-        else:
+            self._push_if_changed(self._default_script_path, script)
+        elif self._stored.script_hashes.pop(self._default_script_path, None):
+            # Only remove the script if it was pushed to this container
             self.container.remove_path(self._default_script_path, recursive=True)
 
     def push_tests_from_relations(self):
         """Push the k6 scripts from relation data to the container."""
-        app_tests = self.k6_tests.tests
-        if not app_tests:
-            return
-        for app, tests in app_tests.items():
+        for app, tests in self._tests.items():
             for test_name, test in tests.items():
-                self.container.push(
-                    self._scripts_folder / Path(app) / Path(test_name),
-                    test,
-                    make_dirs=True,
-                )
+                self._push_if_changed(f"{self._scripts_folder}/{app}/{test_name}", test)
+
+    def _push_if_changed(self, path: str, content: str) -> None:
+        """Push a file to the container, unless the same content was pushed already."""
+        digest = _digest(content)
+        if self._stored.script_hashes.get(path) == digest:
+            return
+        self.container.push(path, content, make_dirs=True)
+        self._stored.script_hashes[path] = digest
 
-    @property
+    @cached_property
     def _k6_version(self) -> Optional[str]:
         """Returns the version of k6."""
-        version_output, _ = self.container.exec(["k6", "--version"]).wait_output()
-        # k6 v0.57.0 (go1.22.12, linux/amd64) ...
-        result = re.search(r"k6 v(\d+\.\d+\.\d+)", version_output)
+        try:
+            version_output, _ = self.container.exec(
+                ["k6", "--version"], timeout=10, combine_stderr=True
+            ).wait_output()
+        except (ChangeError, ExecError) as e:
+            logger.warning("Cannot get the k6 version: %s", e)
+            return None
+        result = _K6_VERSION_RE.search(version_output)
         return result.group(1) if result else None
 
 
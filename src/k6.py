@@ -1,19 +1,22 @@
 """Helper module to handle the communication between the leader units."""
 
-import json
 import logging
 import os
+import re
 import socket
 import typing
-import urllib.request
 import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from enum import Enum
-from types import SimpleNamespace
-from typing import Dict, List, Optional
+from functools import cached_property
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
+import httpx
 import ops
+import orjson
 from cosl import JujuTopology
 from ops import Application, Unit
 from ops.pebble import Layer
@@ -21,7 +24,16 @@ from ops.pebble import Layer
 logger = logging.getLogger(__name__)
 
 
-PORTS = SimpleNamespace(status=6565)
+STATUS_PORT = 6565
+PORTS = (STATUS_PORT,)
+
+# Juju sets the proxy variables once per hook process, so read them once at import
+_HTTPS_PROXY = os.environ.get("JUJU_CHARM_HTTPS_PROXY", "")
+_HTTP_PROXY = os.environ.get("JUJU_CHARM_HTTP_PROXY", "")
+_NO_PROXY = os.environ.get("JUJU_CHARM_NO_PROXY", "")
+
+# KEY=value pairs of the 'environment' config option; values may contain '='
+_ENV_RE = re.compile(r"([^=,]+)=([^,]*)")
 
 
 class K6Status(Enum):
@@ -31,28 +43,53 @@ class K6Status(Enum):
     busy = "busy"  # currently executing `k6 run` (even if paused)
 
 
+# Plain strings for reading and writing the statuses in peer data
+_STATUS_IDLE = K6Status.idle.value
+_STATUS_BUSY = K6Status.busy.value
+
+
+def _dumps(data: Any) -> bytes:
+    """Serialize to JSON bytes with sorted keys."""
+    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+
+
+def _http_client() -> httpx.Client:
+    """Build an HTTP client for the k6 API requests, to be shared across units."""
+    return httpx.Client(
+        # Retry failed connections, e.g. while a unit's k6 API is still coming up
+        transport=httpx.HTTPTransport(
+            retries=3,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        ),
+        # Never let an unresponsive unit block the hook
+        timeout=httpx.Timeout(5.0, connect=2.0),
+    )
+
+
+# The same resume request is sent to every unit: serialize it once
+_RESUME_BODY = _dumps({"data": {"attributes": {"paused": True}}})
+
+
 class K6Api:
     """Helper class to interact with the k6 HTTP API."""
 
     @staticmethod
-    def _request(url: str, method: str, payload: Dict) -> str:
-        request = urllib.request.Request(
+    def _request(client: httpx.Client, url: str, method: str, body: bytes) -> str:
+        response = client.request(
+            method,
             url,
-            data=json.dumps(payload).encode("utf-8"),
-            method=method,
+            content=body,
+            headers={"Content-Type": "application/json"},
         )
-        request.add_header("Content-Type", "application/json")
-        with urllib.request.urlopen(request) as response:
-            if retcode := response.getcode() != 200:
-                raise Exception(f"Cannot start test on {url}: received {retcode}")
-            response_data = response.read()
-            return response_data.decode("utf-8")
+        retcode = response.status_code
+        if retcode != 200:
+            raise RuntimeError(f"Cannot start test on {url}: HTTP {retcode}")
+        return response.text
 
     @staticmethod
-    def resume(endpoint: str) -> None:
+    def resume(endpoint: str, client: httpx.Client) -> None:
         """Resume a paused load test."""
-        k6_resume_payload = {"data": {"attributes": {"paused": True}}}
-        K6Api._request(url=f"http://{endpoint}/status", method="PATCH", payload=k6_resume_payload)
+        K6Api._request(client, url=f"http://{endpoint}/status", method="PATCH", body=_RESUME_BODY)
 
 
 class K6(ops.Object):
@@ -79,6 +116,10 @@ class K6(ops.Object):
         self.container: ops.Container = self._charm.unit.get_container(self._container_name)
         self.prometheus_endpoint: Optional[str] = prometheus_endpoint
         self.loki_endpoint: Optional[str] = loki_endpoint
+        # Parsed peer data by databag name; the K6 object only lives for one hook
+        self._peer_cache: Dict[str, Optional[Dict]] = {}
+        # Whether the k6 service is running, until the charm starts or stops it
+        self._service_running: Optional[bool] = None
 
         self._initialize()
 
@@ -98,30 +139,43 @@ class K6(ops.Object):
         """Store data in the peer relation under the 'k6' key."""
         if not self.peers:
             return
-        self.peers.data[databag]["k6"] = json.dumps(data)
+        # Avoid a relation-set call when the databag already holds the same data
+        if self.get_peer_data(databag) == data:
+            return
+        self.peers.data[databag]["k6"] = _dumps(data).decode("utf-8")
+        # Keep the written value so later reads don't parse it back
+        self._peer_cache[databag.name] = data
 
     def clear_peer_data(self, databag: Unit | Application) -> None:
         """Clear the data stored in peer relation under the 'k6' key."""
         if not self.peers:
             return
         self.peers.data[databag]["k6"] = ""
+        self._peer_cache[databag.name] = None
 
     def get_peer_data(self, databag: Unit | Application) -> Optional[Dict]:
         """Get data from the peer relation under the 'k6' key."""
         if not self.peers:
             return None
-        data = self.peers.data[databag].get("k6")
-        return json.loads(data) if data else None
+        if databag.name not in self._peer_cache:
+            data = self.peers.data[databag].get("k6")
+            self._peer_cache[databag.name] = orjson.loads(data) if data else None
+        return self._peer_cache[databag.name]
 
     def get_all_peer_unit_data(self) -> Optional[Dict]:
         """Get data from the peer relation for all units."""
         if not self.peers:
             return None
         data = {}
-        for unit in [*self.peers.units, self._charm.unit]:
+        for unit in self._all_units:
             data[unit.name] = self.get_peer_data(unit)
         return data
 
+    def _iter_peer_unit_data(self) -> Iterator[Optional[Dict]]:
+        """Lazily get the peer data of each unit, so callers can stop early."""
+        for unit in self._all_units:
+            yield self.get_peer_data(unit)
+
     def _pebble_layer(self) -> Layer:
         """Construct the Pebble layer information."""
         data = self.get_peer_data(self._charm.app)
@@ -129,6 +183,7 @@ class K6(ops.Object):
             return Layer()
 
         labels = self.labels or {}
+        environment = self.environment
         # Build labels for Prometheus
         labels_args: List[str] = [f"--tag {key}={value}" for key, value in labels.items()]
         # Build --log-output=loki argument (see k6 docs "Log output > Loki")
@@ -140,14 +195,14 @@ class K6(ops.Object):
         script_path = data["script_path"]
         # Build the environment args
         environment_args: List[str] = [
-            f"-e {key}={value}" for key, value in self.environment.items()
+            f"-e {key}={value}" for key, value in environment.items()
         ]
 
         # Build the pebble service environment
         service_env: Dict[str, str] = {
-            "https_proxy": os.environ.get("JUJU_CHARM_HTTPS_PROXY", ""),
-            "http_proxy": os.environ.get("JUJU_CHARM_HTTP_PROXY", ""),
-            "no_proxy": os.environ.get("JUJU_CHARM_NO_PROXY", ""),
+            "https_proxy": _HTTPS_PROXY,
+            "http_proxy": _HTTP_PROXY,
+            "no_proxy": _NO_PROXY,
             "K6_PROMETHEUS_RW_SERVER_URL": self.prometheus_endpoint or "",
         }
         # Expose the Loki base URL for xk6-loki scripts
@@ -155,10 +210,21 @@ class K6(ops.Object):
             parsed = urlparse(self.loki_endpoint)
             service_env["LOKI_URL"] = f"{parsed.scheme}://{parsed.netloc}"
         # User-defined environment variables override relation-derived values
-        service_env.update(self.environment)
+        service_env.update(environment)
+
+        # Build the k6 command, skipping the empty arguments
+        k6_args: List[str] = [f"k6 run {script_path}"]
+        if execution_segment := self._execution_segment_args():
+            k6_args.append(execution_segment)
+        k6_args.append(f"--address {self.endpoint}")
+        k6_args.extend(labels_args)
+        k6_args.extend(environment_args)
+        k6_args.append("-o experimental-prometheus-rw")
+        if loki_arg:
+            k6_args.append(loki_arg)
+        command = f"/bin/sh -c '{' '.join(k6_args)}; pebble notify {self._pebble_notice_done}'"
 
         # Build the Pebble layer
-        execution_segment = self._execution_segment_args()
         layer = Layer(
             {
                 "summary": "k6-k8s layer",
@@ -167,16 +233,7 @@ class K6(ops.Object):
                     "k6": {
                         "override": "replace",
                         "summary": "k6 service",
-                        "command": (
-                            f"/bin/sh -c 'k6 run {script_path} "
-                            f"{execution_segment} "
-                            f"--address {self.endpoint} "
-                            f"{' '.join(labels_args)} "
-                            f"{' '.join(environment_args)} "
-                            "-o experimental-prometheus-rw "
-                            f"{loki_arg} "
-                            f"; pebble notify k6.com/done'"
-                        ),
+                        "command": command,
                         "startup": "disabled",
                         "environment": service_env,
                     },
@@ -188,7 +245,7 @@ class K6(ops.Object):
     def _collect_unit_status(self, event: ops.CollectStatusEvent) -> None:
         """Set the status for each unit based on the peer relation databag."""
         data = self.get_peer_data(self._charm.unit)
-        if not data or "status" not in data or data["status"] == K6Status.idle.value:
+        if not data or "status" not in data or data["status"] == _STATUS_IDLE:
             event.add_status(ops.ActiveStatus())
             return
         event.add_status(ops.ActiveStatus(f"k6 status: {data.get('status')}"))
@@ -199,11 +256,12 @@ class K6(ops.Object):
         if not peer_data:
             event.add_status(ops.ActiveStatus("k6 status: idle"))
             return
-        units = self._charm.app.planned_units()
-        busy_units = len([d for d in peer_data.values() if d.get("status") == K6Status.busy.value])
+        statuses = Counter(d.get("status") for d in peer_data.values() if d)
+        busy_units = statuses[_STATUS_BUSY]
         if busy_units == 0:
             event.add_status(ops.ActiveStatus("k6 status: idle"))
             return
+        units = self._charm.app.planned_units()
         event.add_status(ops.ActiveStatus(f"k6 status: busy ({busy_units}/{units} units)"))
 
     def _on_relation_changed(self, _: ops.RelationChangedEvent) -> None:
@@ -212,10 +270,11 @@ class K6(ops.Object):
         # If the necessary information is not in peer data, stop whatever is running
         if not app_data or not app_data.get("script_path"):
             try:
+                self._service_running = None
                 self.container.stop(self._service_name)
                 self.set_peer_data(
                     self._charm.unit,
-                    {"endpoint": self.endpoint, "status": K6Status.idle.value},
+                    {"endpoint": self.endpoint, "status": _STATUS_IDLE},
                 )
             except ops.pebble.APIError:
                 logger.info("k6 is not running")
@@ -223,14 +282,17 @@ class K6(ops.Object):
 
         app_status = app_data.get("status")
         # If app and unit 'status' are 'idle', build the layer and start the tests (from the leader)
-        if app_status == K6Status.idle.value:
+        if app_status == _STATUS_IDLE:
             layer = self._pebble_layer()
-            self.container.add_layer(self._layer_name, layer, combine=True)
-            self.container.replan()
-            self.container.start(self._service_name)
+            # Other units turning 'busy' trigger this again: don't re-add and restart the same test
+            if not self._is_running_layer(layer):
+                self.container.add_layer(self._layer_name, layer, combine=True)
+                self._service_running = None
+                # Restart a k6 still running a previous test on the new layer, start it otherwise
+                self.container.restart(self._service_name)
             self.set_peer_data(
                 self._charm.unit,
-                {"endpoint": self.endpoint, "status": K6Status.busy.value},
+                {"endpoint": self.endpoint, "status": _STATUS_BUSY},
             )
             if self._charm.unit.is_leader():
                 self._start_test_if_ready()
@@ -238,7 +300,7 @@ class K6(ops.Object):
         # If the leader finds all units in 'idle' and the app status is 'busy',
         # it means a test just finished: set the app status to 'idle' and empty
         # the peer app databag.
-        if self._charm.unit.is_leader() and app_status == K6Status.busy.value:
+        if self._charm.unit.is_leader() and app_status == _STATUS_BUSY:
             if self.are_all_units_in_status(K6Status.idle):
                 self.clear_peer_data(self._charm.app)
 
@@ -249,7 +311,7 @@ class K6(ops.Object):
             # Set the unit back to 'idle'
             self.set_peer_data(
                 self._charm.unit,
-                data={"endpoint": self.endpoint, "status": K6Status.idle.value},
+                data={"endpoint": self.endpoint, "status": _STATUS_IDLE},
             )
 
     def _execution_segment_args(self) -> str:
@@ -259,10 +321,7 @@ class K6(ops.Object):
         derived from lexicographically sorted peer unit names, making the
         mapping deterministic and robust to non-contiguous unit numbers.
         """
-        all_units = sorted(
-            [*self.peers.units, self._charm.unit] if self.peers else [self._charm.unit],
-            key=lambda u: u.name,
-        )
+        all_units = sorted(self._all_units, key=lambda u: u.name)
         n = len(all_units)
         if n == 1:
             return ""
@@ -272,10 +331,17 @@ class K6(ops.Object):
         sequence = f"--execution-segment-sequence '{','.join(sequence_parts)}'"
         return f"{segment} {sequence}"
 
-    @property
+    @cached_property
+    def _all_units(self) -> Tuple[Unit, ...]:
+        """All the units of the application, this one included."""
+        if not self.peers:
+            return (self._charm.unit,)
+        return (*self.peers.units, self._charm.unit)
+
+    @cached_property
     def endpoint(self) -> str:
         """The endpoint of the k6 HTTP API."""
-        return f"{socket.getfqdn()}:{PORTS.status}"
+        return f"{socket.getfqdn()}:{STATUS_PORT}"
 
     @property
     def labels(self) -> Optional[Dict[str, str]]:
@@ -284,19 +350,25 @@ class K6(ops.Object):
         data = self.get_peer_data(self._charm.app)
         if not data or "labels" not in data:
             return None
-        # Generate the other labels from Juju topology
-        topology: JujuTopology = JujuTopology.from_charm(self._charm)
         labels = {
             "test_uuid": data["labels"].get("test_uuid") or "",
             "date": data["labels"].get("date") or "",
             "script": data.get("script_path") or "",
-            "juju_charm": topology.charm_name,
+            **self._topology_labels,
+        }
+        return labels
+
+    @cached_property
+    def _topology_labels(self) -> Dict[str, str]:
+        """The labels generated from the Juju topology of this unit."""
+        topology: JujuTopology = JujuTopology.from_charm(self._charm)
+        return {
+            "juju_charm": topology.charm_name or "",
             "juju_model": topology.model,
             "juju_model_uuid": topology.model_uuid,
             "juju_application": topology.application,
-            "juju_unit": topology.unit,
+            "juju_unit": topology.unit or "",
         }
-        return labels
 
     @property
     def environment(self) -> Dict[str, str]:
@@ -307,8 +379,14 @@ class K6(ops.Object):
         environment_raw: str = typing.cast(str, self._charm.config.get("environment", ""))
         if not environment_raw:
             return {}
-        environment = dict(item.split("=") for item in environment_raw.split(","))
-        return environment
+        pairs = _ENV_RE.findall(environment_raw)
+        # Entries without a '=' are not matched: don't let them vanish silently
+        if ",".join(f"{key}={value}" for key, value in pairs) != environment_raw:
+            logger.warning(
+                "Ignoring the malformed parts of the 'environment' config option: %s",
+                environment_raw,
+            )
+        return dict(pairs)
 
     def _initialize(self):
         """Set 'idle' status in each unit if they have no other status."""
@@ -316,7 +394,7 @@ class K6(ops.Object):
         if not data or "status" not in data:
             self.set_peer_data(
                 self._charm.unit,
-                {"endpoint": self.endpoint, "status": K6Status.idle.value},
+                {"endpoint": self.endpoint, "status": _STATUS_IDLE},
             )
 
     def _start_test_if_ready(self):
@@ -328,13 +406,26 @@ class K6(ops.Object):
         ):
             return
         # Update the app 'status' to 'busy'
-        app_data = self.get_peer_data(self._charm.app) or {}
-        app_data["status"] = K6Status.busy.value
+        app_data = {**(self.get_peer_data(self._charm.app) or {}), "status": _STATUS_BUSY}
         self.set_peer_data(self._charm.app, data=app_data)
         # Start the load tests on each unit
         endpoints = [unit_data.get("endpoint") for unit_data in peer_data.values()]
-        for endpoint in endpoints:
-            K6Api.resume(endpoint=endpoint)
+        # Resume the units concurrently, so that they start at about the same time;
+        # the client is built here, before the fan-out, so all the workers share it
+        with (
+            _http_client() as client,
+            ThreadPoolExecutor(max_workers=min(32, len(endpoints))) as executor,
+        ):
+            futures = {
+                endpoint: executor.submit(K6Api.resume, endpoint, client) for endpoint in endpoints
+            }
+        failed: List[str] = []
+        for endpoint, future in futures.items():
+            if error := future.exception():
+                logger.error("Cannot resume the load test on %s: %s", endpoint, error)
+                failed.append(endpoint)
+        if failed:
+            raise RuntimeError(f"Cannot resume the load test on {', '.join(failed)}")
 
     def run(self, *, script_path: str):
         """Set the Pebble layer building blocks in peer data for all units."""
@@ -348,7 +439,7 @@ class K6(ops.Object):
                     "test_uuid": test_uuid,
                     "date": start_time,
                 },
-                "status": K6Status.idle.value,
+                "status": _STATUS_IDLE,
             },
         )
 
@@ -358,25 +449,28 @@ class K6(ops.Object):
 
     def are_all_units_in_status(self, status: K6Status) -> bool:
         """Check whether all k6 have the provided status."""
-        peer_data = self.get_all_peer_unit_data()
-        if not peer_data:
+        if not self.peers:
             return False
-        return all(unit_data.get("status") == status.value for unit_data in peer_data.values())
+        value = status.value
+        return all(d and d.get("status") == value for d in self._iter_peer_unit_data())
 
     def is_running(self) -> bool:
         """Check whether k6 is currently running in any unit."""
-        peer_data = self.get_all_peer_unit_data()
-        busy = K6Status.busy.value
-        if not peer_data:
+        if not self.peers:
+            return False
+        return any(d and d.get("status") == _STATUS_BUSY for d in self._iter_peer_unit_data())
+
+    def _is_running_layer(self, layer: Layer) -> bool:
+        """Check whether k6 is already running the service defined in the layer."""
+        planned = self.container.get_plan().services.get(self._service_name)
+        wanted = layer.services.get(self._service_name)
+        if not planned or not wanted or planned.to_dict() != wanted.to_dict():
             return False
-        return any(unit_data.get("status") == busy for unit_data in peer_data.values())
+        return self.is_running_on_unit()
 
     def is_running_on_unit(self) -> bool:
         """Check whether k6 is currently running in the current unit."""
-        try:
-            service = self.container.get_service(self._service_name)
-            if not service:
-                return False
-            return service.is_running()
-        except ops.ModelError:
-            return False
+        if self._service_running is None:
+            service = self.container.get_services(self._service_name).get(self._service_name)
+            self._service_running = bool(service and service.is_running())
+        return self._service_running
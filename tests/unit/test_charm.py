@@ -2,6 +2,7 @@
 # See LICENSE file for licensing details.
 """Scenario-based unit tests for K6K8sCharm."""
 
+import dataclasses
 import json
 import sys
 from pathlib import Path
@@ -19,7 +20,7 @@ sys.modules.setdefault("charms.istio_beacon_k8s.v0.service_mesh", _svc_mesh)
 import pytest  # noqa: E402
 from ops import testing  # noqa: E402
 
-from charm import K6K8sCharm  # noqa: E402
+from charm import K6K8sCharm, _digest  # noqa: E402
 
 CHARM_ROOT = Path(__file__).parent.parent.parent
 
@@ -93,6 +94,15 @@ def _base_state(
     )
 
 
+def _stored_hashes(state: testing.State, scripts: dict[str, str]) -> testing.State:
+    """Return the state with the given scripts (path -> content) recorded as already pushed."""
+    stored = testing.StoredState(
+        owner_path="K6K8sCharm",
+        content={"script_hashes": {path: _digest(content) for path, content in scripts.items()}},
+    )
+    return dataclasses.replace(state, stored_states={stored})
+
+
 @pytest.fixture
 def ctx():
     return testing.Context(
@@ -129,6 +139,12 @@ class TestReconcile:
         state_out = ctx.run(ctx.on.update_status(), _base_state(container=container))
         assert state_out.workload_version == ""
 
+    def test_failing_version_command(self, ctx):
+        bad_exec = testing.Exec(["k6", "--version"], return_code=1)
+        container = testing.Container("k6", can_connect=True, execs={bad_exec})
+        state_out = ctx.run(ctx.on.update_status(), _base_state(container=container))
+        assert state_out.workload_version == ""
+
     def test_config_script_pushed_to_container(self, ctx):
         script = 'import http from "k6/http"; export default function() {}'
         state_out = ctx.run(
@@ -153,6 +169,43 @@ class TestReconcile:
         assert len(matches) == 1
         assert matches[0].read_text() == test_content
 
+    def test_unchanged_script_not_pushed_again(self, ctx):
+        script = "// already pushed"
+        state = _stored_hashes(
+            _base_state(config={"load-test": script}),
+            {"/etc/k6/scripts/juju-config-script.js": script},
+        )
+        state_out = ctx.run(ctx.on.update_status(), state)
+        fs = state_out.get_container("k6").get_filesystem(ctx)
+        assert not (fs / "etc" / "k6" / "scripts" / "juju-config-script.js").exists()
+
+    def test_pebble_ready_pushes_unchanged_script(self, ctx):
+        script = "// already pushed"
+        state = _stored_hashes(
+            _base_state(config={"load-test": script}),
+            {"/etc/k6/scripts/juju-config-script.js": script},
+        )
+        container = state.get_container("k6")
+        state_out = ctx.run(ctx.on.pebble_ready(container), state)
+        fs = state_out.get_container("k6").get_filesystem(ctx)
+        assert (fs / "etc" / "k6" / "scripts" / "juju-config-script.js").read_text() == script
+
+    def test_unset_config_script_removed(self, ctx, tmp_path):
+        script = tmp_path / "juju-config-script.js"
+        script.write_text("// old script")
+        container = testing.Container(
+            "k6",
+            can_connect=True,
+            execs={K6_VERSION_EXEC},
+            mounts={"scripts": testing.Mount(location="/etc/k6/scripts", source=tmp_path)},
+        )
+        state = _stored_hashes(
+            _base_state(config={}, container=container),
+            {"/etc/k6/scripts/juju-config-script.js": "// old script"},
+        )
+        ctx.run(ctx.on.update_status(), state)
+        assert not script.exists()
+
 
 class TestStartAction:
     def test_non_leader_fails(self, ctx):
@@ -206,3 +259,14 @@ class TestListAction:
 
     def test_leader_lists(self, ctx):
         ctx.run(ctx.on.action("list"), _base_state())
+        assert "(no app) -> (default config script)" in ctx.action_logs[0]
+
+    def test_lists_relation_tests(self, ctx):
+        k6_data = json.dumps({"tests": {"test1.js": "// test"}})
+        rel = testing.Relation(
+            endpoint="receive-k6-tests",
+            remote_app_name="myapp",
+            remote_app_data={"k6": k6_data},
+        )
+        ctx.run(ctx.on.action("list"), _base_state(relations=[rel]))
+        assert "myapp -> test1.js" in ctx.action_logs[0]
@@ -2,8 +2,10 @@
 # See LICENSE file for licensing details.
 """Unit tests for the K6 helper module."""
 
+import json
 from unittest.mock import MagicMock
 
+import httpx
 import pytest
 
 
@@ -28,6 +30,8 @@ def k6_instance():
     k6.peers = None
     k6.prometheus_endpoint = None
     k6.loki_endpoint = None
+    k6._peer_cache = {}
+    k6._service_running = None
     return k6
 
 
@@ -109,3 +113,117 @@ class TestExecutionSegmentArgs:
         result = k6_instance._execution_segment_args()
         assert "--execution-segment '0/2:1/2'" in result
         assert "--execution-segment-sequence '0,1/2,1'" in result
+
+
+class TestIsRunningOnUnit:
+    def test_no_service(self, k6_instance):
+        """Without a k6 service in the plan, k6 is not running."""
+        k6_instance.container.get_services.return_value = {}
+        assert k6_instance.is_running_on_unit() is False
+
+    def test_service_running(self, k6_instance):
+        """A running k6 service is reported as running."""
+        service = MagicMock()
+        service.is_running.return_value = True
+        k6_instance.container.get_services.return_value = {"k6": service}
+        assert k6_instance.is_running_on_unit() is True
+        k6_instance.container.get_services.assert_called_once_with("k6")
+
+    def test_service_state_cached(self, k6_instance):
+        """The service state is only queried once per hook."""
+        k6_instance.container.get_services.return_value = {}
+        assert k6_instance.is_running_on_unit() is False
+        assert k6_instance.is_running_on_unit() is False
+        k6_instance.container.get_services.assert_called_once_with("k6")
+
+
+class TestPeerDataCache:
+    def test_databag_parsed_once(self, k6_instance):
+        """Repeated reads of the same databag only parse its content once."""
+        k6_instance.peers = MagicMock()
+        databag = MagicMock()
+        databag.get.return_value = '{"status": "idle"}'
+        k6_instance.peers.data = {k6_instance._charm.unit: databag}
+
+        assert k6_instance.get_peer_data(k6_instance._charm.unit) == {"status": "idle"}
+        assert k6_instance.get_peer_data(k6_instance._charm.unit) == {"status": "idle"}
+        databag.get.assert_called_once_with("k6")
+
+    def test_write_updates_cache(self, k6_instance):
+        """Writing a databag makes the next read reflect the new content."""
+        k6_instance.peers = MagicMock()
+        databag = {"k6": '{"status": "idle"}'}
+        k6_instance.peers.data = {k6_instance._charm.unit: databag}
+
+        assert k6_instance.get_peer_data(k6_instance._charm.unit) == {"status": "idle"}
+        k6_instance.set_peer_data(k6_instance._charm.unit, {"status": "busy"})
+        assert k6_instance.get_peer_data(k6_instance._charm.unit) == {"status": "busy"}
+
+    def test_unchanged_data_not_written(self, k6_instance):
+        """Writing the data already in the databag does not touch the databag."""
+        writes = []
+
+        class Databag(dict):
+            def __setitem__(self, key, value):
+                writes.append(key)
+                super().__setitem__(key, value)
+
+        k6_instance.peers = MagicMock()
+        k6_instance.peers.data = {k6_instance._charm.unit: Databag()}
+
+        k6_instance.set_peer_data(
+            k6_instance._charm.unit, {"endpoint": "k6-0:6565", "status": "idle"}
+        )
+        k6_instance.set_peer_data(
+            k6_instance._charm.unit, {"status": "idle", "endpoint": "k6-0:6565"}
+        )
+        assert writes == ["k6"]
+
+
+class TestK6Api:
+    def test_resume_patches_status(self):
+        """Resuming a test sends a PATCH to the k6 status endpoint."""
+        from k6 import K6Api
+
+        requests = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            return httpx.Response(200, text="{}")
+
+        client = httpx.Client(transport=httpx.MockTransport(handler))
+        K6Api.resume(endpoint="k6-0:6565", client=client)
+
+        assert len(requests) == 1
+        assert requests[0].method == "PATCH"
+        assert str(requests[0].url) == "http://k6-0:6565/status"
+        assert json.loads(requests[0].content) == {"data": {"attributes": {"paused": True}}}
+
+    def test_error_status_raises(self):
+        """A non-200 answer from the k6 API is an error."""
+        from k6 import K6Api
+
+        client = httpx.Client(transport=httpx.MockTransport(lambda _: httpx.Response(500)))
+        with pytest.raises(RuntimeError, match="HTTP 500"):
+            K6Api.resume(endpoint="k6-0:6565", client=client)
+
+
+class TestEnvironment:
+    def test_parses_comma_separated_pairs(self, k6_instance):
+        """The 'environment' config option is parsed into a dict."""
+        k6_instance.get_peer_data = MagicMock(return_value={"script_path": "test.js"})
+        k6_instance._charm.config.get.return_value = "FOO=bar,BAZ=42"
+        assert k6_instance.environment == {"FOO": "bar", "BAZ": "42"}
+
+    def test_values_can_contain_equal_signs(self, k6_instance):
+        """Only the first '=' of each pair separates the key from the value."""
+        k6_instance.get_peer_data = MagicMock(return_value={"script_path": "test.js"})
+        k6_instance._charm.config.get.return_value = "URL=http://host/?a=b,FOO=bar"
+        assert k6_instance.environment == {"URL": "http://host/?a=b", "FOO": "bar"}
+
+    def test_malformed_entries_logged(self, k6_instance, caplog):
+        """Entries without a '=' are dropped with a warning."""
+        k6_instance.get_peer_data = MagicMock(return_value={"script_path": "test.js"})
+        k6_instance._charm.config.get.return_value = "FOO,BAR=1"
+        assert k6_instance.environment == {"BAR": "1"}
+        assert "malformed" in caplog.text
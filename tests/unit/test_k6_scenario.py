@@ -6,8 +6,10 @@ import json
 import sys
 from unittest.mock import MagicMock, patch
 
+import ops
 import pytest
 from ops import testing
+from ops.pebble import ServiceStatus
 
 # The service_mesh charm library requires httpx/lightkube/pydantic at import
 # time, which are not available in the unit-test venv. Stub the module so that
@@ -45,13 +47,29 @@ def _peer(
     )
 
 
-def _container(*, execs=None, layers=None):
+def _container(*, execs=None, layers=None, service_statuses=None):
     """Build a connectable k6 Container with the version exec mock."""
     return testing.Container(
         "k6",
         can_connect=True,
         execs=execs or {K6_VERSION_EXEC},
         layers=layers or {},
+        service_statuses=service_statuses or {},
+    )
+
+
+def _k6_layer(script_path):
+    """Build a k6 layer running the given script."""
+    return ops.pebble.Layer(
+        {
+            "services": {
+                "k6": {
+                    "override": "replace",
+                    "command": f"/bin/sh -c 'k6 run {script_path}'",
+                    "startup": "disabled",
+                }
+            }
+        }
     )
 
 
@@ -137,6 +155,104 @@ class TestRelationChanged:
         assert "k6 run /etc/k6/scripts/test.js" in svc.command
         assert "pebble notify k6.com/done" in svc.command
 
+    def test_running_test_not_restarted(self):
+        """When this unit already runs the test, later relation-changed events leave it be."""
+        ctx = _ctx()
+        peer = _peer(
+            local_app_data=_app_data(status="idle"),
+            local_unit_data=_unit_data(status="idle"),
+            peers_data={1: _unit_data(status="idle"), 2: _unit_data(status="idle")},
+        )
+        state = testing.State(
+            leader=False,
+            relations=[peer],
+            containers=[_container()],
+        )
+        out = ctx.run(ctx.on.relation_changed(peer, remote_unit=1), state)
+        container = out.get_container("k6")
+        assert container.service_statuses["k6"] == ServiceStatus.ACTIVE
+
+        with patch.object(ops.Container, "add_layer") as add_layer:
+            ctx.run(ctx.on.relation_changed(out.get_relations("k6")[0], remote_unit=2), out)
+        add_layer.assert_not_called()
+
+    def test_new_test_replaces_running_one(self):
+        """A new test started while k6 still runs the previous one restarts the service on it."""
+        ctx = _ctx()
+        peer = _peer(
+            local_app_data=_app_data(status="idle"),
+            local_unit_data=_unit_data(status="busy"),
+            peers_data={1: _unit_data(status="idle")},
+        )
+        container = _container(
+            layers={"k6": _k6_layer("/etc/k6/scripts/old.js")},
+            service_statuses={"k6": ServiceStatus.ACTIVE},
+        )
+        state = testing.State(leader=False, relations=[peer], containers=[container])
+        with patch.object(
+            ops.Container, "restart", autospec=True, side_effect=ops.Container.restart
+        ) as restart:
+            out = ctx.run(ctx.on.relation_changed(peer, remote_unit=1), state)
+
+        restart.assert_called_once()
+        assert restart.call_args.args[1:] == ("k6",)
+        container = out.get_container("k6")
+        assert "k6 run /etc/k6/scripts/test.js" in container.plan.services["k6"].command
+        assert container.service_statuses["k6"] == ServiceStatus.ACTIVE
+
+    def test_leader_resumes_all_units_when_all_busy(self):
+        """Once every unit is busy, the leader resumes the test on all of them."""
+        ctx = _ctx()
+        peer = _peer(
+            local_app_data=_app_data(status="idle"),
+            local_unit_data=_unit_data(status="idle"),
+            peers_data={
+                1: _unit_data(status="busy", endpoint="k6-1:6565"),
+                2: _unit_data(status="busy", endpoint="k6-2:6565"),
+            },
+        )
+        state = testing.State(
+            leader=True,
+            relations=[peer],
+            containers=[_container()],
+        )
+        with patch("k6.K6Api.resume") as resume:
+            out = ctx.run(ctx.on.relation_changed(peer, remote_unit=1), state)
+
+        resumed = {call.args[0] for call in resume.call_args_list}
+        assert {"k6-1:6565", "k6-2:6565"} <= resumed
+        assert len(resumed) == 3
+        # A single HTTP client is shared by all the resume requests
+        assert len({call.args[1] for call in resume.call_args_list}) == 1
+        app_data = json.loads(out.get_relations("k6")[0].local_app_data["k6"])
+        assert app_data["status"] == "busy"
+
+    def test_resume_failures_are_reported_together(self):
+        """A unit failing to resume does not prevent the others from being resumed."""
+        ctx = _ctx()
+        peer = _peer(
+            local_app_data=_app_data(status="idle"),
+            local_unit_data=_unit_data(status="idle"),
+            peers_data={
+                1: _unit_data(status="busy", endpoint="k6-1:6565"),
+                2: _unit_data(status="busy", endpoint="k6-2:6565"),
+            },
+        )
+        state = testing.State(
+            leader=True,
+            relations=[peer],
+            containers=[_container()],
+        )
+
+        def resume(endpoint, client):
+            if endpoint == "k6-1:6565":
+                raise RuntimeError("HTTP 500")
+
+        with patch("k6.K6Api.resume", side_effect=resume) as mock_resume:
+            with pytest.raises(testing.errors.UncaughtCharmError, match="k6-1:6565"):
+                ctx.run(ctx.on.relation_changed(peer, remote_unit=1), state)
+        assert mock_resume.call_count == 3
+
     def test_no_app_data_stops_service_and_sets_idle(self):
         """When app data is empty, the unit is set back to idle."""
         from ops.pebble import Layer
@@ -223,6 +339,31 @@ class TestPebbleLayer:
         container = out.get_container("k6")
         cmd = container.layers["k6"].services["k6"].command
         assert "-o experimental-prometheus-rw" in cmd
+        # Empty optional arguments do not leave stray whitespace behind
+        assert "  " not in cmd
+
+    def test_layer_includes_remote_write_url(self):
+        """With a send-remote-write relation, its endpoint is passed to the k6 service."""
+        ctx = _ctx()
+        peer = _peer(
+            local_app_data=_app_data(),
+            local_unit_data=_unit_data(),
+            peers_data={1: _unit_data()},
+        )
+        remote_write = testing.Relation(
+            endpoint="send-remote-write",
+            remote_units_data={0: {"remote_write": json.dumps({"url": "http://prom/write"})}},
+        )
+        state = testing.State(
+            leader=True,
+            relations=[peer, remote_write],
+            containers=[_container()],
+        )
+        with patch("k6.K6Api.resume"):
+            out = ctx.run(ctx.on.relation_changed(peer, remote_unit=1), state)
+        container = out.get_container("k6")
+        env = container.layers["k6"].services["k6"].environment
+        assert env["K6_PROMETHEUS_RW_SERVER_URL"] == "http://prom/write"
 
     def test_layer_includes_tag_labels(self):
         """The pebble layer includes --tag arguments derived from peer data labels."""
@@ -369,6 +510,22 @@ class TestStatusCollection:
         out = ctx.run(ctx.on.collect_unit_status(), state)
         assert out.app_status == testing.ActiveStatus("k6 status: busy (1/2 units)")
 
+    def test_app_status_with_unit_without_data(self):
+        """A peer unit that has not written its data yet is not counted as busy."""
+        ctx = _ctx()
+        peer = _peer(
+            local_unit_data=_unit_data(status="busy"),
+            peers_data={1: {}},
+        )
+        state = testing.State(
+            leader=True,
+            relations=[peer],
+            containers=[_container()],
+            planned_units=2,
+        )
+        out = ctx.run(ctx.on.collect_unit_status(), state)
+        assert out.app_status == testing.ActiveStatus("k6 status: busy (1/2 units)")
+
 
 # ---------------------------------------------------------------------------
 # run() method (via start action)